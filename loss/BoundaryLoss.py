@@ -101,6 +101,9 @@ class BoundarySoftDice(nn.Module):
         self.k = k
 
     def forward(self, outputs, masks, dist=None):
+        # the network emits logits, convert to class probabilities here
+        outputs = F.softmax(outputs, dim=1)
+
         dice_losses = []
         weight_dice_loss = 0
         all_slice = torch.split(outputs, [1] * self.num_class, dim=1)
@@ -115,4 +118,6 @@ class BoundarySoftDice(nn.Module):
             dice_losses.append(dice_i_loss)
             weight_dice_loss += dice_i_loss * self.weights[i]
 
-        return weight_dice_loss, [dice_loss.item() for dice_loss in dice_losses]
+        # return the per-class losses as tensors; calling item() here would
+        # force one GPU->CPU sync per class on every batch
+        return weight_dice_loss, dice_losses
@@ -1,5 +1,6 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import numpy as np
 from torch.autograd import Function, Variable
 
@@ -48,8 +49,10 @@ class FocalLoss(nn.Module):
         alpha = self.alpha[target.data]
         alpha = Variable(alpha, requires_grad=False)
 
-        probs = (input * mask).sum(1).view(-1, 1) + 1e-10
-        log_probs = probs.log()
+        # the input holds logits, compute the class log-probabilities via
+        # log_softmax, which is numerically stable without an epsilon hack
+        log_probs = (F.log_softmax(input, dim=1) * mask).sum(1).view(-1, 1)
+        probs = log_probs.exp()
 
         if self.gamma > 0:
             batch_loss = -alpha * (torch.pow((1 - probs), self.gamma)) * log_probs
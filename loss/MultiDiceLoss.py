@@ -1,5 +1,6 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import numpy as np
 from torch.autograd import Function, Variable
 
@@ -61,10 +62,13 @@ class MultiDiceLoss(nn.Module):
 
     def forward(self, input_tensor, target):
         """
-        :param input_tensor: network output tensor
+        :param input_tensor: network output tensor (per-class logits)
         :param target: ground truth
         :return: weighted dice loss and a list for all class dice loss, except background
         """
+        # the network emits logits, convert to class probabilities here
+        input_tensor = F.softmax(input_tensor, dim=1)
+
         dice_losses = []
         weight_dice_loss = 0
         all_slice = torch.split(input_tensor, [1] * self.num_class, dim=1)
@@ -83,4 +87,6 @@ class MultiDiceLoss(nn.Module):
             dice_losses.append(dice_i_loss)
             weight_dice_loss += dice_i_loss * self.weights[i]
 
-        return weight_dice_loss, [dice_loss.item() for dice_loss in dice_losses]
+        # return the per-class losses as tensors; calling item() here would
+        # force one GPU->CPU sync per class on every batch
+        return weight_dice_loss, dice_losses
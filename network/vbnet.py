@@ -51,11 +51,6 @@ def vnet_focal_init(net, obj_p):
     net.out_block.conv2.bias.data[1] = -np.log((1 - obj_p) / obj_p)
 
 
-def passthrough(x, **kwargs):
-    # placeholder for dropout layers
-    return x
-
-
 def ELUCons(elu, nchan):
     if elu:
         return nn.ELU(inplace=True)
@@ -63,6 +58,26 @@ def ELUCons(elu, nchan):
         return nn.ReLU(inplace=True)
 
 
+def _conv_bn_relu(x, weight, bias, running_mean, running_var, bn_weight, bn_bias,
+                  stride: int, padding: int, groups: int, training: bool,
+                  momentum: float, eps: float):
+    # conv -> batch norm -> relu chain expressed as one scriptable function, so
+    # the JIT fuser can merge the batch norm scaling and the activation into a
+    # single elementwise kernel after the cuDNN convolution, instead of
+    # round-tripping the activation tensor to memory between the three ops
+    out = F.conv3d(x, weight, bias, stride, padding, 1, groups)
+    out = F.batch_norm(out, running_mean, running_var, bn_weight, bn_bias,
+                       training, momentum, eps)
+    return F.relu_(out)
+
+
+try:
+    fused_conv_bn_relu = torch.jit.script(_conv_bn_relu)
+except Exception:
+    # scripting is best-effort, fall back to the eager chain
+    fused_conv_bn_relu = _conv_bn_relu
+
+
 # normalization between sub-volumes is necessary for good performance
 class ContBatchNorm3d(nn.modules.batchnorm._BatchNorm):
     # a subclass that performs batch normalization on 3D input tensors. Overrides the
@@ -85,19 +100,44 @@ class LUConv_bottle(nn.Module):
     def __init__(self, nchan, elu, act):
         super(LUConv_bottle, self).__init__()
         self.act = act
+        # the fused conv/bn/relu path only implements relu
+        self.fuse = not elu
         self.relu1 = ELUCons(elu, nchan//4)
         self.conv1 = nn.Conv3d(nchan, nchan//4, kernel_size=1, padding=0)
         self.bn1 = nn.BatchNorm3d(nchan//4)
-        
+
         self.relu2 = ELUCons(elu, nchan//4)
         self.conv2 = nn.Conv3d(nchan//4, nchan//4, kernel_size=3, padding=1)
         self.bn2 = nn.BatchNorm3d(nchan//4)
-        
+
         self.relu3 = ELUCons(elu, nchan)
         self.conv3 = nn.Conv3d(nchan//4, nchan, kernel_size=1, padding=0)
         self.bn3 = nn.BatchNorm3d(nchan)
 
     def forward(self, x):
+        # the batch norms may have been folded away for inference, in which
+        # case the fused path no longer applies
+        if self.fuse and isinstance(self.bn1, nn.BatchNorm3d):
+            out = fused_conv_bn_relu(x, self.conv1.weight, self.conv1.bias,
+                                     self.bn1.running_mean, self.bn1.running_var,
+                                     self.bn1.weight, self.bn1.bias,
+                                     1, 0, self.conv1.groups,
+                                     self.training, self.bn1.momentum, self.bn1.eps)
+            out = fused_conv_bn_relu(out, self.conv2.weight, self.conv2.bias,
+                                     self.bn2.running_mean, self.bn2.running_var,
+                                     self.bn2.weight, self.bn2.bias,
+                                     1, 1, self.conv2.groups,
+                                     self.training, self.bn2.momentum, self.bn2.eps)
+            if self.act:
+                out = fused_conv_bn_relu(out, self.conv3.weight, self.conv3.bias,
+                                         self.bn3.running_mean, self.bn3.running_var,
+                                         self.bn3.weight, self.bn3.bias,
+                                         1, 0, self.conv3.groups,
+                                         self.training, self.bn3.momentum, self.bn3.eps)
+            else:
+                out = self.bn3(self.conv3(out))
+            return out
+
         out = self.relu1(self.bn1(self.conv1(x)))
         out = self.relu2(self.bn2(self.conv2(out)))
         if self.act:
@@ -106,39 +146,83 @@ class LUConv_bottle(nn.Module):
             out = self.bn3(self.conv3(out))
         return out
 
+    def forward_split(self, a, b):
+        # apply the block to a channel-split input without materializing the
+        # concatenation: conv(cat(a, b)) == conv_a(a) + conv_b(b)
+        w = self.conv1.weight
+        nchan = a.size(1)
+        out = F.conv3d(a, w[:, :nchan], self.conv1.bias, 1, 0)
+        out = out + F.conv3d(b, w[:, nchan:], None, 1, 0)
+        out = self.relu1(self.bn1(out))
+        out = self.relu2(self.bn2(self.conv2(out)))
+        if self.act:
+            out = self.relu3(self.bn3(self.conv3(out)))
+        else:
+            out = self.bn3(self.conv3(out))
+        return out
+
+
+class LUConv_bottle_dws(LUConv_bottle):
+    # depthwise-separable variant of 'LUConv_bottle': the middle 3x3x3
+    # convolution runs one filter per channel (groups=channels) and the 1x1
+    # conv3 acts as the pointwise merge, cutting the FLOPs of the dominant
+    # convolution roughly 9x at a small accuracy cost
+    def __init__(self, nchan, elu, act):
+        super(LUConv_bottle_dws, self).__init__(nchan, elu, act)
+        self.conv2 = nn.Conv3d(nchan//4, nchan//4, kernel_size=3, padding=1, groups=nchan//4)
+
 
 class LUConv(nn.Module):
     # simplified version of 'LUConv_bottle' without the bottleneck structure.
     def __init__(self, nchan, elu, act):
         super(LUConv, self).__init__()
         self.act = act
+        # the fused conv/bn/relu path only implements relu
+        self.fuse = not elu
         self.relu1 = ELUCons(elu, nchan)
         self.conv1 = nn.Conv3d(nchan, nchan, kernel_size=3, padding=1)
         self.bn1 = nn.BatchNorm3d(nchan)
-        
+
     def forward(self, x):
         if self.act:
-            out = self.relu1(self.bn1(self.conv1(x)))
+            # the batch norm may have been folded away for inference, in which
+            # case the fused path no longer applies
+            if self.fuse and isinstance(self.bn1, nn.BatchNorm3d):
+                out = fused_conv_bn_relu(x, self.conv1.weight, self.conv1.bias,
+                                         self.bn1.running_mean, self.bn1.running_var,
+                                         self.bn1.weight, self.bn1.bias,
+                                         1, 1, self.conv1.groups,
+                                         self.training, self.bn1.momentum, self.bn1.eps)
+            else:
+                out = self.relu1(self.bn1(self.conv1(x)))
         else:
             out = self.bn1(self.conv1(x))
         return out
 
+    def forward_split(self, a, b):
+        # apply the block to a channel-split input without materializing the
+        # concatenation: conv(cat(a, b)) == conv_a(a) + conv_b(b)
+        w = self.conv1.weight
+        nchan = a.size(1)
+        out = F.conv3d(a, w[:, :nchan], self.conv1.bias, 1, 1)
+        out = out + F.conv3d(b, w[:, nchan:], None, 1, 1)
+        out = self.bn1(out)
+        if self.act:
+            out = self.relu1(out)
+        return out
 
-def _make_nConv(nchan, depth, elu, use_bottle):
-    # function that creates a sequence of LUConv or LUConv_bottle modules based on the 
-    # specified number of channels, depth, and other parameters
-    layers = []
-    for i in range(depth):
-        if use_bottle:
-            if i != depth - 1:
-                layers.append(LUConv_bottle(nchan, elu, act=True))
-            else:
-                layers.append(LUConv_bottle(nchan, elu, act=False))
-        else:
-            if i != depth - 1:
-                layers.append(LUConv(nchan, elu, act=True))
-            else:
-                layers.append(LUConv(nchan, elu, act=False))
+
+def _make_nConv(nchan, depth, elu, use_bottle, dws=False):
+    # function that creates a homogeneous sequence of LUConv or LUConv_bottle
+    # modules; 'dws' selects the depthwise-separable bottleneck variant
+    # every block ends in its activation, so the sequence is a uniform static
+    # graph the compiler can fuse end to end; the residual add-and-activate
+    # lives in the parent transition instead of a special last block
+    if use_bottle:
+        block = LUConv_bottle_dws if dws else LUConv_bottle
+    else:
+        block = LUConv
+    layers = [block(nchan, elu, act=True) for _ in range(depth)]
     return nn.Sequential(*layers)
 
 
@@ -166,20 +250,21 @@ class DownTransition(nn.Module):
     # module that represents a downsampling path in the network. It includes a 3D 
     # convolutional layer with stride 2 for downsampling, followed by batch normalization, 
     # activation, and a series of LUConv or LUConv_bottle modules
-    def __init__(self, inChans, nConvs, elu, dropout=False, use_bottle=False):
+    def __init__(self, inChans, nConvs, elu, dropout=False, use_bottle=False, dws=False):
         super(DownTransition, self).__init__()
         outChans = 2*inChans
         self.down_conv = nn.Conv3d(inChans, outChans, kernel_size=2, stride=2)
         self.bn1 = nn.BatchNorm3d(outChans)
-        self.do1 = passthrough
         self.relu1 = ELUCons(elu, outChans)
         self.relu2 = ELUCons(elu, outChans)
-        self.ops = _make_nConv(outChans, nConvs, elu, use_bottle)
+        self.ops = _make_nConv(outChans, nConvs, elu, use_bottle, dws)
 
     def forward(self, x):
         down = self.relu1(self.bn1(self.down_conv(x)))
-        out = self.do1(down)
-        out = self.ops(out)
+        out = self.ops(down)
+        # the ops output is saved by its in-place activation for backward, so
+        # the residual add cannot mutate it; the add/relu pair fuses under
+        # torch.compile
         out = self.relu2(torch.add(out, down))
         return out
 
@@ -189,43 +274,48 @@ class UpTransition(nn.Module):
     # convolutional layer with stride 2 for upsampling, followed by batch normalization, 
     # activation, dropout, concatenation with the skip connection, and a series of LUConv or
     # LUConv_bottle modules
-    def __init__(self, inChans, outChans, nConvs, elu, dropout=False, use_bottle=False):
+    def __init__(self, inChans, outChans, nConvs, elu, dropout=False, use_bottle=False, dws=False):
         super(UpTransition, self).__init__()
         self.up_conv = nn.ConvTranspose3d(inChans, outChans // 2, kernel_size=2, stride=2)
         self.bn1 = nn.BatchNorm3d(outChans // 2)
-        self.do1 = passthrough
         self.do2 = nn.Dropout3d(p=0.2)
         self.relu1 = ELUCons(elu, outChans // 2)
         self.relu2 = ELUCons(elu, outChans)
-        self.ops = _make_nConv(outChans, nConvs, elu, use_bottle)
+        self.ops = _make_nConv(outChans, nConvs, elu, use_bottle, dws)
 
     def forward(self, x, skipx):
-        out = self.do1(x)
         skipxdo = self.do2(skipx)
-        out = self.relu1(self.bn1(self.up_conv(out)))
-        xcat = torch.cat((out, skipxdo), 1)
-        out = self.ops(xcat)
-        out = self.relu2(torch.add(out, xcat))
-        return out
+        out = self.relu1(self.bn1(self.up_conv(x)))
+        # feed the channel-split pair straight into the first block through
+        # split convolution weights, so the upsampled features and the skip
+        # connection are never concatenated into a temporary tensor
+        res = self.ops[0].forward_split(out, skipxdo)
+        for op in self.ops[1:]:
+            res = op(res)
+        # residual add against the never-materialized concat, half by half;
+        # the ops output is saved by its in-place activation for backward, so
+        # the adds cannot mutate it
+        nchan = out.size(1)
+        res = torch.cat((res[:, :nchan] + out, res[:, nchan:] + skipxdo), 1)
+        return self.relu2(res)
 
 
 class OutputTransition(nn.Module):
     # module that performs the final transition from the network to the output segmentation
-    # map. It consists of two 3D convolutional layers, batch normalization, activation, and
-    # softmax function
+    # map. It consists of two 3D convolutional layers, batch normalization and activation,
+    # and emits per-class logits; the losses apply softmax/log_softmax themselves, which is
+    # numerically more stable and saves one full pass over the output tensor
     def __init__(self, inChans, outChans, elu):
         super(OutputTransition, self).__init__()
         self.conv1 = nn.Conv3d(inChans, outChans, kernel_size=3, padding=1)
         self.bn1 = nn.BatchNorm3d(outChans)
         self.conv2 = nn.Conv3d(outChans, outChans, kernel_size=1)
         self.relu1 = ELUCons(elu, outChans)
-        self.softmax = nn.Softmax(dim=1)
 
     def forward(self, x):
         # convolve 32 down to 2 channels
         out = self.relu1(self.bn1(self.conv1(x)))
         out = self.conv2(out)
-        out = self.softmax(out)
         return out
 
 
@@ -233,15 +323,15 @@ class SegmentationNet(nn.Module):
     # the number of convolutions in each layer corresponds
     # to what is in the actual prototxt, not the intent
     # [DOES NOT INCLUDE PreBlock AND PostBlock, WHICH ARE IN vbbnet.py]
-    def __init__(self, in_channels, out_channels, elu=False):
+    def __init__(self, in_channels, out_channels, elu=False, dws=False):
         super(SegmentationNet, self).__init__()
         self.in_tr = InputTransition(in_channels, elu)
         self.down_tr32 = DownTransition(16, 2, elu, use_bottle=False)
-        self.down_tr64 = DownTransition(32, 3, elu, use_bottle=True)
-        self.down_tr128 = DownTransition(64, 4, elu, dropout=True, use_bottle=True)
-        self.down_tr256 = DownTransition(128, 4, elu, dropout=True, use_bottle=True)
-        self.up_tr256 = UpTransition(256, 256, 4, elu, dropout=True, use_bottle=True)
-        self.up_tr128 = UpTransition(256, 128, 4, elu, dropout=True, use_bottle=True)
+        self.down_tr64 = DownTransition(32, 3, elu, use_bottle=True, dws=dws)
+        self.down_tr128 = DownTransition(64, 4, elu, dropout=True, use_bottle=True, dws=dws)
+        self.down_tr256 = DownTransition(128, 4, elu, dropout=True, use_bottle=True, dws=dws)
+        self.up_tr256 = UpTransition(256, 256, 4, elu, dropout=True, use_bottle=True, dws=dws)
+        self.up_tr128 = UpTransition(256, 128, 4, elu, dropout=True, use_bottle=True, dws=dws)
         self.up_tr64 = UpTransition(128, 64, 3, elu, use_bottle=False)
         self.up_tr32 = UpTransition(64, 32, 2, elu, use_bottle=False)
         self.out_tr = OutputTransition(32, out_channels, elu)
@@ -10,6 +10,7 @@ import codecs
 from easydict import EasyDict as edict
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from utils.tools import read_test_txt, read_test_csv, read_test_folder
 from utils.SegModel import *
 from utils.dataset import fix_normalizers, adaptive_normalizers, resize_image_itk
@@ -119,6 +120,9 @@ def network_output(iso_batch, model, pre_image, resample_image):
     probs=[]
     with torch.no_grad():
         prob = model.net(iso_batch)
+        # the network emits logits, convert to probabilities so the saved
+        # probability map stays in [0, 1]; the argmax mask is unaffected
+        prob = F.softmax(prob, dim=1)
 
     _, mask = prob.max(1)
     mask = mask.short()
@@ -6,6 +6,7 @@ import importlib
 import os
 import sys
 import time
+import random
 import shutil
 import numpy as np
 import easydict
@@ -13,8 +14,11 @@ from comet_ml import Experiment
 from comet_ml.integration.pytorch import log_model
 import torch
 import torch.nn as nn
+import torch.distributed as dist
 from torch.backends import cudnn
+from torch.nn.parallel import DistributedDataParallel
 from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
 from torchmetrics.functional import dice
 import matplotlib
 import matplotlib.pyplot as plt
@@ -34,9 +38,12 @@ def worker_init(worker_idx):
     """
     MAX_INT = sys.maxsize
     worker_seed = np.random.randint(int(np.sqrt(MAX_INT))) + worker_idx
+    # the dataset draws from the global NumPy and random module generators, so
+    # those are the ones to seed; do not touch torch.cuda here, it would spin
+    # up a full CUDA context in every loader worker process
     np.random.seed(worker_seed)
+    random.seed(worker_seed)
     torch.manual_seed(worker_seed)
-    torch.cuda.manual_seed(worker_seed)
 
 def load_module_from_disk(pyfile):
     """
@@ -85,8 +92,11 @@ def save_checkpoint(net, opt, epoch_idx, batch_idx, cfg, config_file, max_stride
     state = {'epoch':             epoch_idx,
              'batch':             batch_idx,
              'net':               cfg.net.name,
+             'dws':               cfg.net.get('dws', False),
              'max_stride':        max_stride,
-             'state_dict':        net.state_dict(),
+             # store the plain module's parameters so the checkpoint is
+             # interchangeable across DDP/DataParallel/torch.compile wrappers
+             'state_dict':        unwrap_net(net).state_dict(),
              'spacing':           cfg.dataset.spacing,
              'interpolation':     cfg.dataset.interpolation,
              'pad_t':             cfg.dataset.pad_t,
@@ -105,27 +115,31 @@ def save_checkpoint(net, opt, epoch_idx, batch_idx, cfg, config_file, max_stride
     shutil.copy(config_file, os.path.join(chk_folder, 'config.py'))
 
 
-def load_checkpoint(epoch_idx, net, opt, save_dir):
+def load_checkpoint(epoch_idx, net, opt, save_dir, map_location=None):
     """
     load network parameters and optimizer state from corresonding checkpoint files in directory
     :param epoch_idx: the epoch idx of model to load
     :param net: the network object
     :param opt: the optimizer object
     :param save_dir: the save directory
+    :param map_location: device to load the parameters onto, avoids staging a
+        multi-GB checkpoint through CPU memory when loading straight to GPU
     :return: loaded epoch index, loaded batch index
     """
     # load network parameters
     chk_file = os.path.join(save_dir, 'checkpoints', 'chk_{}'.format(epoch_idx), 'params.pth')
     assert os.path.isfile(chk_file), 'checkpoint file not found: {}'.format(chk_file)
 
-    state = load_pytorch_model(chk_file)
-    net.load_state_dict(state['state_dict'])
+    state = load_pytorch_model(chk_file, map_location=map_location)
+    # load into the plain network; stripping wrapper prefixes keeps
+    # checkpoints from older trainers (DataParallel and/or compile) loadable
+    unwrap_net(net).load_state_dict(strip_wrapper_prefixes(state['state_dict']))
 
     # load optimizer state
     opt_file = os.path.join(save_dir, 'checkpoints', 'chk_{}'.format(epoch_idx), 'optimizer.pth')
     assert os.path.isfile(opt_file), 'optimizer file not found: {}'.format(chk_file)
 
-    opt_state = load_pytorch_model(opt_file)
+    opt_state = load_pytorch_model(opt_file, map_location=map_location)
     opt.load_state_dict(opt_state)
 
     return state['epoch'], state['batch']
@@ -160,32 +174,35 @@ def plot_progress(cfg, batch_idx, all_tr_losses):
 
 def calculate_loss(loss_func_list, output, mask, weights):
     """
-    calculate the losses and total loss given a list of loss functions, network output, 
+    calculate the losses and total loss given a list of loss functions, network output,
     target mask, and weights
     :param loss_func_list: list of loss functions
     :param output: network output
     :param mask: target mask
-    :param weights: weights for the different loss functions
-    :return: individual losses and the total loss
+    :param weights: 1D GPU tensor of weights for the different loss functions
+    :return: stacked individual losses and the total loss
     """
-    assert len(loss_func_list) == len(weights)
+    assert len(loss_func_list) == weights.numel()
     losses = []
-    total_loss = 0
 
-    for i, loss_func in enumerate(loss_func_list):
+    for loss_func in loss_func_list:
         loss_value = loss_func(output, mask)
         if isinstance(loss_value, tuple):
             loss_value = loss_value[0]
-        loss_value = loss_value.cuda()
         losses.append(loss_value)
-        total_loss += weights[i] * loss_value
 
-    return losses, total_loss.cuda()
+    # one stack + dot instead of N scalar multiply-adds keeps the weighted sum
+    # at two autograd nodes regardless of the number of losses
+    losses = torch.stack(losses)
+    total_loss = torch.dot(weights, losses)
+
+    return losses, total_loss
 
 
 def train(config_file, msg_queue=None):
-    """ 
+    """
     volumetric segmentation training engine
+    launch with 'torchrun --nproc_per_node=N train.py', one process per GPU
     :param config_file: the input configuration file
     :param msg_queue: message queue to export runtime message to integrated system
     :return: None
@@ -194,9 +211,11 @@ def train(config_file, msg_queue=None):
     assert torch.cuda.is_available(), 'CUDA is not available! Please check nvidia driver!'
     assert os.path.isfile(config_file), 'Config not found: {}'.format(config_file)
 
-    # pick GPU
-    os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
-    os.environ["CUDA_VISIBLE_DEVICES"] = "2"
+    # one process per GPU, local rank is provided by torchrun
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    dist.init_process_group(backend='nccl')
+    torch.cuda.set_device(local_rank)
+    rank = dist.get_rank()
 
     # load the configuration file and assigns it to the variable cfg.
     cfg = load_module_from_disk(config_file)
@@ -213,15 +232,19 @@ def train(config_file, msg_queue=None):
     torch.manual_seed(cfg.general.seed)
     torch.cuda.manual_seed(cfg.general.seed)
 
-    # initialize Comet for tracking training progress
-    experiment = Experiment(
-        api_key = "7xOfvCpZbXepFuUXEoehda5i6",
-        project_name = "RTP_1",
-        workspace="whschellekens"
-        )
+    # initialize Comet for tracking training progress, only on the master process
+    experiment = None
+    if rank == 0:
+        experiment = Experiment(
+            api_key = "7xOfvCpZbXepFuUXEoehda5i6",
+            project_name = "RTP_1",
+            workspace="whschellekens"
+            )
+        experiment.set_name("dsc logging added")
 
     # clean the existing folder when training is stopped, if it exists
-    if cfg.general.resume_epoch < 0 and os.path.isdir(cfg.general.save_dir):
+    # only the master process prompts, the other ranks wait at the barrier
+    if rank == 0 and cfg.general.resume_epoch < 0 and os.path.isdir(cfg.general.save_dir):
         sys.stdout.write("Found non-empty save dir.\n"
                          "Type 'yes' to delete, 'no' to continue: ")
         choice = input().lower()
@@ -231,10 +254,18 @@ def train(config_file, msg_queue=None):
             pass
         else:
             raise ValueError("Please type either 'yes' or 'no'!")
+    dist.barrier()
 
-    # enable CUDNN
+    # enable CUDNN autotuning; the crop size is fixed, so the algorithm search
+    # runs once and stable algorithms are reused for every batch
     cudnn.benchmark = True
 
+    # allow TF32 on Ampere+ for the FP32 parts of the pipeline, roughly 2x
+    # matmul/conv throughput at negligible precision cost
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    torch.set_float32_matmul_precision("high")
+
     # dataset
     dataset = SegmentationDataset(
         imlist_file=cfg.general.imseg_list,
@@ -247,23 +278,40 @@ def train(config_file, msg_queue=None):
         interpolation=cfg.dataset.interpolation,
         crop_normalizers=cfg.dataset.crop_normalizers)
 
-    sampler = EpochConcateSampler(dataset, cfg.train.epochs)
+    # each process samples a disjoint shard of the dataset per epoch
+    sampler = DistributedSampler(dataset)
 
     # create a data loader for the dataset with custom sampling and worker initialization
+    # worker startup is expensive for volumetric data (image loading and
+    # resampling), so keep workers alive across epochs and prefetch deeper;
+    # both options require num_workers > 0
+    loader_kwargs = {}
+    if cfg.train.num_threads > 0:
+        loader_kwargs = {'persistent_workers': True, 'prefetch_factor': 4}
     data_loader = DataLoader(dataset, sampler=sampler, batch_size=cfg.train.batchsize,
-                             num_workers=cfg.train.num_threads, pin_memory=True, worker_init_fn=worker_init)
+                             num_workers=cfg.train.num_threads, pin_memory=True, worker_init_fn=worker_init,
+                             **loader_kwargs)
 
     # define the network architecture using the specified network module
-    gpu_ids = list(range(cfg.general.num_gpus))
-
     net_module = importlib.import_module('network.' + cfg.net.name)
-    net = net_module.SegmentationNet(dataset.num_modality(), cfg.dataset.num_classes)
+    net = net_module.SegmentationNet(dataset.num_modality(), cfg.dataset.num_classes,
+                                     dws=cfg.net.get('dws', False))
     max_stride = [16, 16, 16]
-    
-    # initialize the network with kaiming initialization and move it to GPU
+
+    # initialize the network with kaiming initialization and move it to this process' GPU
+    # channels-last (NDHWC) layout hits the faster cuDNN Tensor Core Conv3d kernels
     vnet_kaiming_init(net)
-    net = nn.parallel.DataParallel(net, device_ids=gpu_ids)
-    net = net.cuda()
+    net = net.cuda(local_rank).to(memory_format=torch.channels_last_3d)
+
+    # compile the whole network before the DDP wrap; the forward pass is a
+    # static graph of conv/bn/act/cat/add, which Inductor can fuse while also
+    # removing the per-layer Python dispatch overhead
+    try:
+        net = torch.compile(net, mode="max-autotune")
+    except Exception:
+        print('torch.compile not available, running the network eagerly')
+
+    net = DistributedDataParallel(net, device_ids=[local_rank])
     # summary(net, (1, 96, 96, 96), 6)
 
     assert np.all(np.array(cfg.dataset.crop_size) % np.array(max_stride) == 0), 'crop size not divisible by max stride'
@@ -274,10 +322,13 @@ def train(config_file, msg_queue=None):
         lr=cfg.train.lr, **cfg.train.optimizer.params
     )
 
-    # load checkpoint if resume epoch > 0
+    # load checkpoint if resume epoch > 0; the checkpoint stores the plain
+    # module's parameters, which load_checkpoint unwraps to, straight onto
+    # this process' GPU
     if cfg.general.resume_epoch >= 0:
-        net = torch.load(os.path.join(cfg.general.save_dir, 'checkpoints', 'chk_{}'.cfg.general.resume_epoch))
-        last_save_epoch, batch_start = cfg.general.resume_epoch, 0
+        last_save_epoch, batch_start = load_checkpoint(cfg.general.resume_epoch, net, opt,
+                                                       cfg.general.save_dir,
+                                                       map_location='cuda:{}'.format(local_rank))
     else:
         last_save_epoch, batch_start = 0, 0
 
@@ -285,91 +336,123 @@ def train(config_file, msg_queue=None):
     scheduler = getattr(torch.optim.lr_scheduler, cfg.train.lr_scheduler.name+"LR")(
         optimizer=opt, **cfg.train.lr_scheduler.params)
 
+    # build the loss functions once, using the specified loss names and weights
+    loss_func_list = []
+    if 'Dice' in cfg.loss.name:
+        from loss.MultiDiceLoss import MultiDiceLoss
+        loss_func_list.append(MultiDiceLoss(weights=cfg.loss.obj_weight, num_class=cfg.dataset.num_classes))
+    if 'Focal' in cfg.loss.name:
+        from loss.FocalLoss import FocalLoss
+        loss_func_list.append(FocalLoss(class_num=cfg.dataset.num_classes,
+                                        alpha=cfg.loss.obj_weight, gamma=cfg.loss.focal_gamma))
+    if 'Boundary' in cfg.loss.name:
+        from loss.BoundaryLoss import BoundarySoftDice
+        loss_func_list.append(BoundarySoftDice(
+                        k=cfg.loss.k_max,
+                        weights=cfg.loss.obj_weight,
+                        num_class=cfg.dataset.num_classes,
+                        level=cfg.loss.level, dim=cfg.loss.dim))
+
+    assert len(loss_func_list) == len(cfg.loss.loss_weight), \
+        'number of valid losses should equal to that of given weights'
+
+    # the loss weights are static, upload them to the GPU once
+    loss_weights = torch.tensor(cfg.loss.loss_weight, dtype=torch.float32,
+                                device='cuda:{}'.format(local_rank))
+
+    # gradient scaler for mixed-precision training, keeps FP16 gradients
+    # from underflowing
+    scaler = torch.cuda.amp.GradScaler()
+
     batch_idx = batch_start
     if cfg.general.clear_start_epoch:
         batch_idx = 0
-    data_iter = iter(data_loader)
 
     all_tr_losses = []
-    batch_losses = []
     batches = []
-    # loop over batches
-    for i in range(len(data_loader)):
-
-        begin_t = time.time()
-
-        # loads the input crops, masks, and filenames from the data loader
-        crops, masks, filenames = next(data_iter)
-
-        crops, masks = crops.cuda(), masks.cuda()
-
-        # clear previous gradients
-        opt.zero_grad()
-
-        # perform a forward pass through the network
-        outputs = net(crops)
-
-        # calculate Dice coefficient
-        DSC = dice(outputs, masks.type(torch.int64), num_classes=cfg.dataset.num_classes, average="micro")
-
-        # the epoch idx of model
-        epoch_idx = batch_idx * cfg.train.batchsize // len(dataset)
-
-        # calculate the losses using the specified loss functions and weights
-        loss_func_list = []
-        if 'Dice' in cfg.loss.name:
-            from loss.MultiDiceLoss import MultiDiceLoss
-            loss_func_list.append(MultiDiceLoss(weights=cfg.loss.obj_weight, num_class=cfg.dataset.num_classes))
-        if 'Focal' in cfg.loss.name:
-            from loss.FocalLoss import FocalLoss
-            loss_func_list.append(FocalLoss(class_num=cfg.dataset.num_classes,
-                                            alpha=cfg.loss.obj_weight, gamma=cfg.loss.focal_gamma))
-        if 'Boundary' in cfg.loss.name:
-            from loss.BoundaryLoss import BoundarySoftDice
-            loss_func_list.append(BoundarySoftDice(
-                            k=cfg.loss.k_max,
-                            weights=cfg.loss.obj_weight,
-                            num_class=cfg.dataset.num_classes,
-                            level=cfg.loss.level, dim=cfg.loss.dim))
-
-        assert len(loss_func_list) == len(cfg.loss.loss_weight), \
-            'number of valid losses should equal to that of given weights'
-
-        losses, train_loss = calculate_loss(loss_func_list, outputs, masks, cfg.loss.loss_weight)
-
-        # perform backward propagation and update the weights
-        train_loss.backward()
-
-        # update weights
-        opt.step()
-
-        if epoch_idx != scheduler.last_epoch:
-            scheduler.step()
-        
-        batch_idx += 1
-        batch_duration = time.time() - begin_t
-        sample_duration = batch_duration * 1.0 / cfg.train.batchsize
-        batch_losses.append(train_loss.item())
-
-        # print training loss per batch       
-        if (batch_idx + 1) % cfg.train.plot_snapshot == 0:
-            all_tr_losses.append(sum(batch_losses)/len(batch_losses))
-            batches.append(batch_idx)
-            batch_losses=[]
-            plot_progress(cfg, batches, all_tr_losses)
-
-        # log process in Comet
-        experiment.set_name("dsc logging added")
-        # log_model(experiment, net, model_name="RTP_Model") # not sure if 'net' is correct but it seems to work
-        experiment.log_metrics({"training loss_": train_loss,
-                                "dice score": DSC}, epoch=epoch_idx)
 
-        # save checkpoints at specified intervals
-        if epoch_idx != 0 and (epoch_idx % cfg.train.save_epochs == 0):
+    # running loss kept on the GPU so accumulating it never synchronizes;
+    # it is read back with a single item() per logging window
+    loss_accum = torch.zeros(1, device='cuda:{}'.format(local_rank))
+    accum_count = 0
+    # loop over epochs, each epoch covers one pass over this process' dataset shard
+    for epoch_idx in range(last_save_epoch, cfg.train.epochs):
+
+        # reshuffle the shards so every process sees a different split each epoch
+        sampler.set_epoch(epoch_idx)
+
+        # loop over batches, prefetching the next batch's H2D copy on a side
+        # stream so it overlaps with the current forward/backward
+        prefetcher = CUDAPrefetcher(data_loader, memory_format=torch.channels_last_3d)
+        for crops, masks, filenames in prefetcher:
+
+            begin_t = time.time()
+
+            # clear previous gradients; set_to_none frees them instead of
+            # memsetting a model-sized buffer every iteration
+            opt.zero_grad(set_to_none=True)
+
+            # perform a forward pass through the network in mixed precision
+            with torch.cuda.amp.autocast(dtype=torch.float16):
+                outputs = net(crops)
+
+            # compute the losses (including the final softmax) in FP32
+            outputs = outputs.float()
+
+            # calculate the losses using the specified loss functions and weights
+            losses, train_loss = calculate_loss(loss_func_list, outputs, masks, loss_weights)
+
+            # perform backward propagation and update the weights through the
+            # gradient scaler
+            scaler.scale(train_loss).backward()
+
+            # update weights
+            scaler.step(opt)
+            scaler.update()
+
+            batch_idx += 1
+            batch_duration = time.time() - begin_t
+            sample_duration = batch_duration * 1.0 / cfg.train.batchsize
+
+            if rank == 0:
+                loss_accum += train_loss.detach()
+                accum_count += 1
+
+            # read the loss back and log every plot_snapshot batches only;
+            # item() forces a GPU->CPU sync, so keep it off the per-batch path
+            if rank == 0 and (batch_idx + 1) % cfg.train.plot_snapshot == 0:
+                # calculate Dice coefficient on the current batch; the network
+                # emits logits, so take the per-voxel argmax as the predicted
+                # labels. Computing it here keeps the 3D volume reduction off
+                # the per-batch critical path
+                DSC = dice(outputs.argmax(1), masks, num_classes=cfg.dataset.num_classes, average="micro")
+
+                # one sync for the whole window: mean loss plus the Dice score
+                mean_loss = (loss_accum / accum_count).item()
+                loss_accum.zero_()
+                accum_count = 0
+
+                all_tr_losses.append(mean_loss)
+                batches.append(batch_idx)
+                plot_progress(cfg, batches, all_tr_losses)
+
+                # log process in Comet, only on the master process and only
+                # once per window, with plain Python scalars so the HTTP
+                # client never touches GPU tensors
+                # log_model(experiment, net, model_name="RTP_Model") # not sure if 'net' is correct but it seems to work
+                experiment.log_metrics({"training loss_": mean_loss,
+                                        "dice score": DSC.item()}, epoch=epoch_idx, step=batch_idx)
+
+        scheduler.step()
+
+        # save checkpoints at specified intervals, only on the master process
+        if rank == 0 and epoch_idx != 0 and (epoch_idx % cfg.train.save_epochs == 0):
             if last_save_epoch != epoch_idx:
                 save_checkpoint(net, opt, epoch_idx, batch_idx, cfg, config_file, max_stride, dataset.num_modality())
                 last_save_epoch = epoch_idx
 
+    dist.destroy_process_group()
+
 
 def main():
     """entry point of the script"""
@@ -107,26 +107,33 @@ class VSegModel(object):
         net_name = state['net']
         self.network_type = net_name
 
+        # rebuild the network with the same block variant it was trained with
+        dws = state.get('dws', False)
+
         if net_name == 'vbnet':
             from network import vbnet
             net_module = vbnet
-            self.net = net_module.SegmentationNet(self.in_channels, self.out_channels)
+            self.net = net_module.SegmentationNet(self.in_channels, self.out_channels, dws=dws)
         elif net_name == 'vbbnet':
             from network import vbbnet
             net_module = vbbnet
-            self.net = net_module.SegmentationNet(self.in_channels, self.out_channels)
+            self.net = net_module.SegmentationNet(self.in_channels, self.out_channels, dws=dws)
         else:
             raise ValueError("Net name should be either '2D_net' or '25D_net'!")
         
+        # load the state dictionary's saved network parameters into the plain
+        # network; stripping wrapper prefixes keeps checkpoints written with
+        # DataParallel/DDP/torch.compile wrappers loadable
+        self.net.load_state_dict(strip_wrapper_prefixes(state['state_dict']))
+
         # setup the network for parallel execution on multiple GPUs
         self.net = nn.parallel.DataParallel(self.net)
         self.net = self.net.cuda()
-        
-        # load the state dictionary's saved network parameters into the network
-        self.net.load_state_dict(state['state_dict'])
-        
-        # set network to evaluation mode
+
+        # set network to evaluation mode and fold batch norm layers into the
+        # preceding convolutions for faster inference
         self.net.eval()
+        fuse_bn_recursively(self.net)
 
     @staticmethod
     def __normalizer_from_dict(crop_normalizer):
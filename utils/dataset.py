@@ -308,9 +308,10 @@ class SegmentationDataset(Dataset):
 
             seg = np.flip(seg, axis)
 
-        # convert to tensors
+        # convert to tensors; the mask is yielded as int64 labels so the
+        # training loop does not have to cast a full volume every batch
         im = torch.from_numpy(np.array(images))
-        seg = torch.from_numpy(np.array([seg]))
+        seg = torch.from_numpy(np.array([seg])).long()
 
         return im, seg, case_name
 
@@ -1,5 +1,6 @@
 import io
 import torch
+import torch.nn as nn
 import numpy as np
 from Crypto.Cipher import AES
 import base64
@@ -37,6 +38,141 @@ class EpochConcateSampler(Sampler):
 
 
 
+class CUDAPrefetcher(object):
+    """Iterate a data loader one batch ahead of the training loop.
+
+    The next batch's host-to-device copy is issued on a dedicated CUDA stream
+    while the current batch is still being computed, so the copy overlaps with
+    forward/backward instead of stalling the GPU. Requires the data loader to
+    be created with pin_memory=True for the copies to be truly asynchronous.
+
+    Arguments:
+        loader (DataLoader): loader yielding (crops, masks, filenames)
+        memory_format: optional memory format to convert the crops to
+    """
+
+    def __init__(self, loader, memory_format=None):
+        self.loader = iter(loader)
+        self.memory_format = memory_format
+        self.stream = torch.cuda.Stream()
+        self._preload()
+
+    def _preload(self):
+        try:
+            self.next_crops, self.next_masks, self.next_names = next(self.loader)
+        except StopIteration:
+            self.next_crops, self.next_masks, self.next_names = None, None, None
+            return
+        with torch.cuda.stream(self.stream):
+            self.next_crops = self.next_crops.cuda(non_blocking=True)
+            self.next_masks = self.next_masks.cuda(non_blocking=True)
+            if self.memory_format is not None:
+                self.next_crops = self.next_crops.to(memory_format=self.memory_format)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.next_crops is None:
+            raise StopIteration
+        # make the compute stream wait until the prefetched copy has landed
+        torch.cuda.current_stream().wait_stream(self.stream)
+        crops, masks, names = self.next_crops, self.next_masks, self.next_names
+        crops.record_stream(torch.cuda.current_stream())
+        masks.record_stream(torch.cuda.current_stream())
+        self._preload()
+        return crops, masks, names
+
+
+def unwrap_net(net):
+    """
+    return the plain network under DataParallel/DistributedDataParallel and
+    torch.compile wrappers, so checkpoints always store unprefixed parameter
+    names regardless of how the network was wrapped for training
+    :param net: a possibly wrapped network
+    :return: the unwrapped network
+    """
+    while True:
+        if isinstance(net, (nn.DataParallel, nn.parallel.DistributedDataParallel)):
+            net = net.module
+        elif hasattr(net, '_orig_mod'):
+            net = net._orig_mod
+        else:
+            return net
+
+
+def strip_wrapper_prefixes(state_dict):
+    """
+    remove the 'module.' (DataParallel/DDP) and '_orig_mod.' (torch.compile)
+    prefixes from state dict keys, so checkpoints written by older trainers
+    with any combination of wrappers load into the plain network
+    :param state_dict: the saved network state dict
+    :return: a state dict with unprefixed keys
+    """
+    prefixes = ('module.', '_orig_mod.')
+    clean = {}
+    for key, value in state_dict.items():
+        # the prefixes can stack, e.g. 'module._orig_mod.' from DDP + compile
+        stripped = True
+        while stripped:
+            stripped = False
+            for prefix in prefixes:
+                if key.startswith(prefix):
+                    key = key[len(prefix):]
+                    stripped = True
+        clean[key] = value
+    return clean
+
+
+def fuse_conv_bn(conv, bn):
+    """
+    fold a BatchNorm3d layer into the preceding Conv3d/ConvTranspose3d layer
+    at eval time batch norm is a linear transform, so it can be absorbed into
+    the convolution weight and bias: w' = w * gamma / sqrt(var + eps) and
+    b' = (b - mean) * gamma / sqrt(var + eps) + beta
+    :param conv: the convolution layer
+    :param bn: the batch normalization layer that follows it
+    :return: the convolution layer with the folded weight and bias
+    """
+    scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+
+    # transposed convolution weights are [in, out, d, h, w], so the output
+    # channel dimension to scale differs from a regular convolution
+    if isinstance(conv, nn.ConvTranspose3d):
+        conv.weight.data.mul_(scale.reshape(1, -1, 1, 1, 1))
+    else:
+        conv.weight.data.mul_(scale.reshape(-1, 1, 1, 1, 1))
+
+    if conv.bias is None:
+        conv.bias = nn.Parameter(torch.zeros_like(bn.running_mean))
+    conv.bias.data = (conv.bias.data - bn.running_mean) * scale + bn.bias
+
+    return conv
+
+
+def fuse_bn_recursively(module):
+    """
+    walk the module tree and fold every BatchNorm3d that directly follows a
+    Conv3d/ConvTranspose3d into that convolution, replacing the batch norm
+    with an identity; this removes one kernel launch and one full activation
+    read/write per conv block at inference time
+    note: only valid on a network in eval mode, training needs live BN stats
+    :param module: the network (or submodule) to fuse in place
+    :return: the fused module
+    """
+    prev_child = None
+    for name, child in module.named_children():
+        if isinstance(child, nn.BatchNorm3d) and \
+                isinstance(prev_child, (nn.Conv3d, nn.ConvTranspose3d)):
+            fuse_conv_bn(prev_child, child)
+            setattr(module, name, nn.Identity())
+        else:
+            fuse_bn_recursively(child)
+        prev_child = child
+
+    return module
+
+
 def last_checkpoint(chk_root):
     """
     find the directory of last check point
@@ -188,9 +324,10 @@ class Crypto(object):
         return plain_text.rstrip(b'\0')[0:-1]
         
 
-def load_pytorch_model(path):
+def load_pytorch_model(path, map_location=None):
     """
     :param path: model path
+    :param map_location: optional device to load the parameters onto
     :return: model params
     """
     with open(path, "rb") as fid:
@@ -202,7 +339,7 @@ def load_pytorch_model(path):
             decrypt_buffer = io.BytesIO(crypto_handle.bytes_decrypt(buffer_value[128::]))
         else:
             decrypt_buffer = buffer
-    params = torch.load(decrypt_buffer)
+    params = torch.load(decrypt_buffer, map_location=map_location)
     return params
       
     